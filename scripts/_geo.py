@@ -0,0 +1,38 @@
+"""
+Spherical geometry helpers for the build script.
+
+Points are projected onto the unit sphere so that nearest-neighbour searches
+can run on a plain Euclidean KD-tree; chord lengths convert to and from
+great-circle distance exactly.
+"""
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def latlon_to_xyz(lats, lons):
+    """Project lat/lon degrees onto the unit sphere; returns an (N, 3) array."""
+    lat = np.radians(np.asarray(lats, dtype=float))
+    lon = np.radians(np.asarray(lons, dtype=float))
+    return np.column_stack((np.cos(lat) * np.cos(lon),
+                            np.cos(lat) * np.sin(lon),
+                            np.sin(lat)))
+
+
+def km_to_chord(km):
+    """Unit-sphere chord length spanning a great-circle distance of km."""
+    return 2 * np.sin(km / EARTH_RADIUS_KM / 2)
+
+
+def chord_to_km(chord):
+    """Great-circle distance in km spanned by a unit-sphere chord."""
+    return 2 * EARTH_RADIUS_KM * np.arcsin(chord / 2)
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance in km; any argument may be a NumPy array."""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
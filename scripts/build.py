@@ -9,15 +9,22 @@ Usage:
 
 import argparse
 import csv
+import hashlib
 import json
+import os
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 
 import osxphotos
 import requests
-from PIL import Image, ImageOps
-from geopy.distance import geodesic
+import numpy as np
+from PIL import ExifTags, Image, ImageOps
+from scipy.spatial import cKDTree
+
+from _geo import chord_to_km, haversine_km, km_to_chord, latlon_to_xyz
 
 try:
     import pillow_heif
@@ -32,7 +39,9 @@ PHOTOS_OUT = ROOT / "docs" / "photos"
 DATA_DIR   = ROOT / "data"
 DOCS_DIR   = ROOT / "docs"
 SETTLEMENTS_FILE = DATA_DIR / "settlements.json"
+SETTLEMENTS_XYZ  = DATA_DIR / "settlements.npy"
 CORRECTIONS_FILE = DATA_DIR / "corrections.json"
+PHOTO_CACHE_FILE = DATA_DIR / "photo_cache.json"
 DATA_OUT         = DOCS_DIR / "data.json"
 
 # ── Config ────────────────────────────────────────────────────────────────────
@@ -42,59 +51,120 @@ CLUSTER_RADIUS_M = 50
 CLUSTER_MINUTES  = 2
 MATCH_RADIUS_KM  = 1.5
 MAX_PHOTO_PX     = (1200, 1200)
+# No optimize pass: the extra Huffman pass costs more time than the bytes it saves.
+JPEG_OPTIONS     = {"quality": 85, "optimize": False, "progressive": False, "subsampling": 2}
+# Bump when save_web_photo() changes how it resizes or encodes.
+PHOTO_EXPORT_VERSION = 1
+# Stored in the photo cache; any change forces every web photo to be re-exported.
+PHOTO_SETTINGS = {"version": PHOTO_EXPORT_VERSION, "max_px": list(MAX_PHOTO_PX), **JPEG_OPTIONS}
 
 
 # ── Photo loading & deduplication ─────────────────────────────────────────────
 
-def load_photos_from_library():
+def load_photo_cache():
+    """Return {source path: mtime_ns} for photos exported by the previous build.
+
+    Returns {} when the previous build used different PHOTO_SETTINGS, so that
+    every web photo is re-encoded with the current ones.
+    """
+    if PHOTO_CACHE_FILE.exists():
+        with open(PHOTO_CACHE_FILE) as f:
+            cache = json.load(f)
+        if isinstance(cache, dict) and cache.get("settings") == PHOTO_SETTINGS:
+            return cache["photos"]
+        print("  Photo export settings changed; re-exporting all photos")
+    return {}
+
+
+def _check_image(path, cached_mtime):
+    """Check that path opens as an image; returns (mtime_ns, None) or (None, exception).
+
+    Files whose mtime matches cached_mtime were exported by an earlier build
+    and are not opened again.  Otherwise the file is closed straight away:
+    pixels are only needed at export time, and keeping every HEIC decoder
+    context open for the whole build wastes memory.
+    """
+    try:
+        mtime = os.stat(path).st_mtime_ns
+        if mtime != cached_mtime:
+            with Image.open(path):
+                pass
+        return mtime, None
+    except Exception as exc:
+        return None, exc
+
+
+def load_photos_from_library(cache):
     """Load photos from the macOS Photos album, reading directly from the library."""
     db = osxphotos.PhotosDB()
     album_photos = db.photos(albums=[ALBUM_NAME])
     print(f"  Found {len(album_photos)} photos in '{ALBUM_NAME}' album")
 
-    photos = []
+    candidates = []
     for p in album_photos:
         lat, lon = p.location
         if lat is None or lon is None:
             print(f"  skip  {p.original_filename}  (no GPS)")
             continue
-        path = p.path
-        if path is None:
+        if p.path is None:
             print(f"  skip  {p.original_filename}  (not downloaded from iCloud)")
             continue
-        try:
-            img = Image.open(path)
+        candidates.append(p)
+
+    # Opening a HEIC parses its container in pillow-heif's C code, which
+    # releases the GIL, so files are opened in parallel.  map() keeps album order.
+    photos = []
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        checked = pool.map(_check_image, [p.path for p in candidates],
+                           [cache.get(str(p.path)) for p in candidates])
+        for p, (mtime, exc) in zip(candidates, checked):
+            if exc is not None:
+                print(f"  error {p.original_filename}: {exc}")
+                continue
             photos.append({
-                "path":     Path(path),
-                "img":      img,
-                "coords":   (lat, lon),
+                "path":     Path(p.path),
+                "mtime_ns": mtime,
+                "coords":   p.location,
                 "datetime": p.date.replace(tzinfo=None),
             })
-        except Exception as exc:
-            print(f"  error {p.original_filename}: {exc}")
 
     return photos
 
 
 def cluster_photos(photos):
-    """Group photos within CLUSTER_RADIUS_M metres AND CLUSTER_MINUTES of each other.
+    """Group photos into chains of pairs within CLUSTER_RADIUS_M metres AND CLUSTER_MINUTES.
+
+    Close pairs are found with a KD-tree over unit-sphere coordinates and joined
+    with union-find, so a chain of nearby shots ends up in a single cluster even
+    when its two ends are further apart than either limit.
 
     Returns a list of clusters; each cluster is a list of photo dicts sorted
     newest-first.  Clusters are also sorted newest-first (by their most recent photo).
     """
-    clusters = []
-    for photo in photos:
-        placed = False
-        for cluster in clusters:
-            rep = cluster[0]
-            dist = geodesic(photo["coords"], rep["coords"]).meters
-            mins = abs((photo["datetime"] - rep["datetime"]).total_seconds()) / 60
-            if dist <= CLUSTER_RADIUS_M and mins <= CLUSTER_MINUTES:
-                cluster.append(photo)
-                placed = True
-                break
-        if not placed:
-            clusters.append([photo])
+    if not photos:
+        return []
+
+    xyz = latlon_to_xyz([p["coords"][0] for p in photos],
+                        [p["coords"][1] for p in photos])
+    radius = km_to_chord(CLUSTER_RADIUS_M / 1000)
+
+    parent = list(range(len(photos)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in cKDTree(xyz).query_pairs(radius):
+        mins = abs((photos[i]["datetime"] - photos[j]["datetime"]).total_seconds()) / 60
+        if mins <= CLUSTER_MINUTES:
+            parent[find(i)] = find(j)
+
+    groups = {}
+    for i, photo in enumerate(photos):
+        groups.setdefault(find(i), []).append(photo)
+    clusters = list(groups.values())
 
     for c in clusters:
         c.sort(key=lambda p: p["datetime"], reverse=True)
@@ -112,13 +182,33 @@ area["name"="Suffolk"]["boundary"="administrative"]["admin_level"="6"]->.suffolk
 );
 out body;
 """
+# Raw Overpass response, keyed by query so editing the query never reuses stale data.
+# Overpass has no conditional requests, so a response younger than
+# OVERPASS_CACHE_HOURS is reused instead of re-running the query.
+OVERPASS_CACHE = DATA_DIR / f"overpass-{hashlib.sha1(OVERPASS_QUERY.encode()).hexdigest()}.json"
+OVERPASS_CACHE_HOURS = 24
 
 
 def fetch_settlements():
-    print("Fetching Suffolk settlements from OpenStreetMap (this may take ~30s)…")
-    resp = requests.post(OVERPASS_URL, data={"data": OVERPASS_QUERY}, timeout=120)
-    resp.raise_for_status()
-    elements = resp.json()["elements"]
+    DATA_DIR.mkdir(exist_ok=True)
+    age_hours = None
+    if OVERPASS_CACHE.exists():
+        age_hours = (time.time() - OVERPASS_CACHE.stat().st_mtime) / 3600
+    if age_hours is not None and age_hours < OVERPASS_CACHE_HOURS:
+        print(f"Reusing OpenStreetMap response from {age_hours:.1f} h ago "
+              f"(refetched after {OVERPASS_CACHE_HOURS} h)…")
+        with open(OVERPASS_CACHE) as f:
+            elements = json.load(f)["elements"]
+    else:
+        print("Fetching Suffolk settlements from OpenStreetMap (this may take ~30s)…")
+        resp = requests.post(OVERPASS_URL, data={"data": OVERPASS_QUERY}, timeout=120)
+        resp.raise_for_status()
+        elements = resp.json()["elements"]
+        OVERPASS_CACHE.write_bytes(resp.content)
+        # Responses cached for earlier versions of the query are never read again.
+        for old in DATA_DIR.glob("overpass-*.json"):
+            if old != OVERPASS_CACHE:
+                old.unlink()
 
     settlements = []
     for el in elements:
@@ -133,9 +223,9 @@ def fetch_settlements():
         })
 
     print(f"  Found {len(settlements)} settlements")
-    DATA_DIR.mkdir(exist_ok=True)
     with open(SETTLEMENTS_FILE, "w") as f:
         json.dump(settlements, f, indent=2)
+    SETTLEMENTS_XYZ.unlink(missing_ok=True)
     return settlements
 
 
@@ -146,27 +236,62 @@ def load_settlements(refresh=False):
             return json.load(f)
     return fetch_settlements()
 
+
+def load_settlement_xyz(settlements):
+    """Unit-sphere coordinates of settlements, cached in SETTLEMENTS_XYZ.
+
+    The cache is rebuilt whenever it is older than SETTLEMENTS_FILE or its
+    length no longer matches.
+    """
+    if (SETTLEMENTS_XYZ.exists() and SETTLEMENTS_FILE.exists()
+            and SETTLEMENTS_XYZ.stat().st_mtime >= SETTLEMENTS_FILE.stat().st_mtime):
+        xyz = np.load(SETTLEMENTS_XYZ, mmap_mode="r")
+        if len(xyz) == len(settlements):
+            return xyz
+    xyz = latlon_to_xyz([s["lat"] for s in settlements],
+                        [s["lon"] for s in settlements])
+    np.save(SETTLEMENTS_XYZ, xyz)
+    return xyz
+
 # ── Matching ──────────────────────────────────────────────────────────────────
 
-def nearest_settlement(coords, settlements):
-    """Return (settlement, distance_km) for nearest within MATCH_RADIUS_KM, else (None, None)."""
-    best, best_dist = None, float("inf")
-    for s in settlements:
-        d = geodesic(coords, (s["lat"], s["lon"])).km
-        if d < best_dist:
-            best, best_dist = s, d
-    if best_dist <= MATCH_RADIUS_KM:
-        return best, best_dist
-    return None, None
+def match_settlements(coords, settlement_xyz):
+    """Match each (lat, lon) in coords to its nearest settlement in one KD-tree query.
+
+    settlement_xyz holds the settlements' unit-sphere coordinates, row for row.
+    Returns a list of (settlement index, distance_km), with (None, None) for points
+    whose nearest settlement is further than MATCH_RADIUS_KM.
+    """
+    if not coords:
+        return []
+    tree = cKDTree(settlement_xyz)
+    chords, idxs = tree.query(latlon_to_xyz([c[0] for c in coords],
+                                            [c[1] for c in coords]), k=1)
+    dists_km = chord_to_km(chords)
+
+    matches = []
+    for i, d in zip(idxs, dists_km):
+        if d <= MATCH_RADIUS_KM:
+            matches.append((int(i), float(d)))
+        else:
+            matches.append((None, None))
+    return matches
 
 # ── Image output ──────────────────────────────────────────────────────────────
 
-def save_web_photo(img, out_path):
-    copy = ImageOps.exif_transpose(img)   # correct rotation from EXIF orientation tag
-    copy.thumbnail(MAX_PHOTO_PX, Image.LANCZOS)
-    if copy.mode not in ("RGB", "L"):
-        copy = copy.convert("RGB")
-    copy.save(out_path, "JPEG", quality=85, optimize=True)
+def save_web_photo(src_path, out_path):
+    """Write a resized JPEG copy of src_path (a path, so it can run in a worker process)."""
+    with Image.open(src_path) as img:
+        if img.format == "JPEG":
+            # Let libjpeg decode at 1/2, 1/4 or 1/8 scale; thumbnail() finishes the resize.
+            img.draft("RGB", MAX_PHOTO_PX)
+        # exif_transpose() copies the full image even when nothing needs turning.
+        if img.getexif().get(ExifTags.Base.Orientation, 1) != 1:
+            img = ImageOps.exif_transpose(img)   # correct rotation from EXIF orientation tag
+        img.thumbnail(MAX_PHOTO_PX, Image.LANCZOS)
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        img.save(out_path, "JPEG", **JPEG_OPTIONS)
 
 # ── Main build ────────────────────────────────────────────────────────────────
 
@@ -175,7 +300,8 @@ def build(refresh_settlements=False):
 
     # 1. Photos
     print(f"\nReading from Photos library …")
-    raw = load_photos_from_library()
+    photo_cache = load_photo_cache()
+    raw = load_photos_from_library(photo_cache)
     print(f"  {len(raw)} photos with GPS data")
     clusters = cluster_photos(raw)
     total_photos = sum(len(c) for c in clusters)
@@ -184,38 +310,45 @@ def build(refresh_settlements=False):
     # 2. Settlements
     print()
     settlements = load_settlements(refresh_settlements)
+    settlement_xyz = load_settlement_xyz(settlements)
 
     # 3. Match & export
     print("\nMatching clusters to settlements…")
-    visited_names = set()
-    visited = []
+    visited_mask = np.zeros(len(settlements), dtype=bool)
+    visited, visited_idxs = [], []
+    src_paths, out_paths = [], []
+    exported = {}   # source path -> mtime_ns, saved as the next build's photo cache
 
-    # clusters are already sorted newest-first; remove stale photos before writing.
-    for old in PHOTOS_OUT.iterdir():
-        old.unlink()
+    # Use each cluster's most-recent photo's coords for settlement matching.
+    matches = match_settlements([c[0]["coords"] for c in clusters], settlement_xyz)
 
-    for cluster in clusters:
-        # Use the most-recent photo's coords for settlement matching.
+    for cluster, (idx, dist) in zip(clusters, matches):
         rep = cluster[0]
-        settlement, dist = nearest_settlement(rep["coords"], settlements)
-        if settlement is None:
+        if idx is None:
             print(f"  no match  {rep['path'].name}  (nearest >1.5km)")
             continue
 
+        settlement = settlements[idx]
         name = settlement["name"]
-        if name in visited_names:
+        if visited_mask[idx]:
             print(f"  dup match {rep['path'].name}  → {name}, skipping")
             continue
-        visited_names.add(name)
+        visited_mask[idx] = True
 
-        # Save every photo in the cluster.
+        # Queue every photo in the cluster for export.
         photo_paths = []
         for photo in cluster:
             out_name = photo["path"].stem + ".jpg"
-            save_web_photo(photo["img"], PHOTOS_OUT / out_name)
+            key = str(photo["path"])
+            exported[key] = photo["mtime_ns"]
+            # Unchanged since the last build: the existing web copy is still good.
+            if photo_cache.get(key) != photo["mtime_ns"] or not (PHOTOS_OUT / out_name).exists():
+                src_paths.append(photo["path"])
+                out_paths.append(PHOTOS_OUT / out_name)
             photo_paths.append(f"photos/{out_name}")
 
         date_str = rep["datetime"].strftime("%Y-%m-%d") if rep["datetime"] != datetime.min else None
+        visited_idxs.append(idx)
         visited.append({
             "name":   name,
             "lat":    settlement["lat"],
@@ -226,38 +359,54 @@ def build(refresh_settlements=False):
         count_str = f" ({len(cluster)} photos)" if len(cluster) > 1 else ""
         print(f"  ✓  {name:<30}  {dist:.2f} km{count_str}")
 
+    # Remove web copies of photos that are no longer exported.
+    keep = {Path(p).stem + ".jpg" for p in exported}
+    for old in PHOTOS_OUT.iterdir():
+        if old.name not in keep:
+            old.unlink()
+
+    # JPEG encoding is CPU-bound, so spread it across processes.
+    print(f"\nSaving {len(out_paths)} web photos ({len(exported) - len(out_paths)} unchanged)…")
+    with ProcessPoolExecutor() as pool:
+        list(pool.map(save_web_photo, src_paths, out_paths))
+    with open(PHOTO_CACHE_FILE, "w") as f:
+        json.dump({"settings": PHOTO_SETTINGS, "photos": exported}, f, indent=2)
+
     # 4. Apply manual corrections (wrong village matched due to GPS offset)
     if CORRECTIONS_FILE.exists():
         with open(CORRECTIONS_FILE) as f:
             corrections = json.load(f)   # {"Wrong Name": "Correct Name", ...}
-        settlement_by_name = {s["name"]: s for s in settlements}
-        for entry in visited:
+        settlement_by_name = {s["name"]: i for i, s in enumerate(settlements)}
+        for entry, idx in zip(visited, visited_idxs):
             if entry["name"] in corrections:
                 wrong = entry["name"]
                 correct = corrections[wrong]
                 if correct in settlement_by_name:
-                    s = settlement_by_name[correct]
+                    correct_idx = settlement_by_name[correct]
+                    s = settlements[correct_idx]
                     entry["name"] = correct
                     entry["lat"]  = s["lat"]
                     entry["lon"]  = s["lon"]
-                    visited_names.discard(wrong)
-                    visited_names.add(correct)
+                    visited_mask[idx] = False
+                    visited_mask[correct_idx] = True
                     print(f"  correction: {wrong} → {correct}")
                 else:
                     print(f"  warning: correction target '{correct}' not found in settlements")
 
     # 5. Unvisited with distance from home
     print("\nBuilding unvisited list…")
+    lats = np.array([s["lat"] for s in settlements])
+    lons = np.array([s["lon"] for s in settlements])
+    home_km = haversine_km(HOME_COORDS[0], HOME_COORDS[1], lats, lons).round(1)
     unvisited = []
-    for s in settlements:
-        if s["name"] not in visited_names:
-            d = geodesic(HOME_COORDS, (s["lat"], s["lon"])).km
-            unvisited.append({
-                "name":        s["name"],
-                "lat":         s["lat"],
-                "lon":         s["lon"],
-                "distance_km": round(d, 1),
-            })
+    for i in np.flatnonzero(~visited_mask):
+        s = settlements[i]
+        unvisited.append({
+            "name":        s["name"],
+            "lat":         s["lat"],
+            "lon":         s["lon"],
+            "distance_km": float(home_km[i]),
+        })
 
     # 5. Write data.json
     data = {
@@ -269,8 +418,9 @@ def build(refresh_settlements=False):
             "generated": datetime.now().strftime("%Y-%m-%d"),
         },
     }
+    # Compact separators: the site fetches this on every page load.
     with open(DATA_OUT, "w") as f:
-        json.dump(data, f, indent=2)
+        json.dump(data, f, separators=(",", ":"))
 
     # Write unvisited CSV sorted by distance from home
     csv_out = DOCS_DIR / "unvisited.csv"
@@ -278,8 +428,7 @@ def build(refresh_settlements=False):
     with open(csv_out, "w", newline="") as f:
         writer = csv.writer(f)
         writer.writerow(["Settlement", "Distance from home (km)"])
-        for s in sorted_unvisited:
-            writer.writerow([s["name"], s["distance_km"]])
+        writer.writerows([s["name"], s["distance_km"]] for s in sorted_unvisited)
 
     total = data["stats"]["total"]
     pct   = 100 * len(visited) / total if total else 0